@@ -1,13 +1,275 @@
 import torch
-import numpy as np
-from diffusers import LuminaText2ImgPipeline, FlowMatchEulerDiscreteScheduler
+import torch._dynamo
+import torch._inductor.config
+from diffusers import LuminaText2ImgPipeline, FlowMatchEulerDiscreteScheduler, ImagePipelineOutput
 from transformers import AutoModel, AutoTokenizer
 import comfy.model_management as mm
 import os
-import traceback
 import math
+import functools
+import gc
+import logging
+from collections import OrderedDict
 from .utils import get_2d_rotary_pos_embed_lumina, ODE
 
+logger = logging.getLogger(__name__)
+
+# The loaded pipeline keyed by (model_path, quantization), shared by every node instance in the process.
+# Holds at most one entry so switching models or quantization never keeps two pipelines on the GPU.
+_PIPE_CACHE = {}
+
+def reset_compiled_code(*fns):
+    # Drop Dynamo's compiled graphs for just these functions. torch._dynamo.reset() would also throw away
+    # the graphs of every other compiled model in the process, e.g. ones from ComfyUI's TorchCompileModel node.
+    for fn in fns:
+        torch._dynamo.reset_code(getattr(fn, "__func__", fn).__code__)
+
+def clear_pipeline_cache():
+    # Graphs compiled for the old pipeline live in Dynamo's caches, drop them so their memory is released too
+    for pipe in _PIPE_CACHE.values():
+        pipe.reset_compiled()
+    _PIPE_CACHE.clear()
+    # The cached rotary tables live on the device as well
+    get_2d_rotary_pos_embed_lumina.cache_clear()
+    gc.collect()
+    mm.soft_empty_cache()
+
+def enable_compile_cache():
+    # Keep compiled kernels next to the node so restarts of ComfyUI skip most of the compile warm-up
+    cache_dir = os.environ.get("TORCHINDUCTOR_CACHE_DIR", os.path.join(os.path.dirname(__file__), ".torch_compile_cache"))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        # e.g. a read-only custom_nodes directory, compiling still works without the disk cache
+        logger.warning(f"Could not create the compile cache directory {cache_dir}, skipping the disk cache: {e}")
+        return
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    # The env var is only read when the config module is imported, so set it directly as well,
+    # unless the user turned the cache off
+    if os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] == "1":
+        torch._inductor.config.fx_graph_cache = True
+
+def channels_last_decode(decode):
+    # Hand the latents to the VAE in NHWC so its convolutions don't have to convert layouts
+    @functools.wraps(decode)
+    def wrapper(z, *args, **kwargs):
+        return decode(z.contiguous(memory_format=torch.channels_last), *args, **kwargs)
+    return wrapper
+
+def quantize_transformer(transformer, quantization):
+    if quantization == "none":
+        return
+
+    try:
+        from torchao.quantization import quantize_, float8_weight_only, int8_weight_only
+    except ImportError:
+        logger.warning("torchao is not installed, skipping transformer quantization. Install it with: pip install torchao")
+        return
+
+    config = float8_weight_only() if quantization == "fp8" else int8_weight_only()
+    # Keep the attention projections in full precision, they are the most sensitive to quantization error
+    quantize_(transformer, config, filter_fn=lambda module, fqn: (
+        isinstance(module, torch.nn.Linear) and not fqn.endswith(("to_q", "to_k", "to_v"))))
+    logger.info(f"Quantized transformer weights to {quantization}.")
+
+class LuminaCustomPipeline(LuminaText2ImgPipeline):
+    """Lumina pipeline that integrates the latents with our ODE solver instead of the scheduler loop."""
+
+    prompt_cache_size = 16
+    compiled_shapes_size = 4
+
+    def __init__(self, transformer, scheduler, vae, text_encoder, tokenizer):
+        super().__init__(transformer=transformer, scheduler=scheduler, vae=vae, text_encoder=text_encoder, tokenizer=tokenizer)
+        self.compiled_transformers = {}
+        self.compiled_shapes = set()
+        self.eager_components = None
+        self.prompt_cache = OrderedDict()
+
+    def set_components_compiled(self, enabled):
+        # Compile the VAE decoder and text encoder, or put the eager versions back when compiling is turned off
+        if enabled and self.eager_components is None:
+            self.eager_components = (self.vae.decode, self.text_encoder)
+            self.transformer.to(memory_format=torch.channels_last)
+            # The VAE has data-dependent branches that break fullgraph, and the text encoder sees variable sequence lengths
+            self.vae.decode = torch.compile(self.vae.decode, mode="reduce-overhead", fullgraph=False)
+            self.text_encoder = torch.compile(self.text_encoder, mode="reduce-overhead")
+        elif not enabled and self.eager_components is not None:
+            self.vae.decode, self.text_encoder = self.eager_components
+            self.eager_components = None
+
+    def reset_compiled(self):
+        # Dynamo caches graphs on the code of whatever was compiled: the modules' forwards and the VAE decode wrapper
+        functions = [type(self.transformer).forward]
+        if self.eager_components is not None:
+            decode, text_encoder = self.eager_components
+            functions += [decode, type(text_encoder).forward]
+        reset_compiled_code(*functions)
+        self.compiled_shapes.clear()
+
+    def get_transformer(self, compile_backend, height, width, batch_size, do_classifier_free_guidance,
+                        max_sequence_length, proportional_attn):
+        # One compiled module per backend. With dynamic=False, Dynamo keeps a separate static graph (and CUDA Graph)
+        # per set of guarded inputs in its cache on transformer.forward, so recent settings reuse their graphs.
+        if compile_backend is None:
+            return self.transformer
+
+        # Everything the graphs are specialized on: the transformer batch doubles with guidance, which also
+        # changes the strides of t and the prompt embeddings, and proportional_attn changes the attention kwargs
+        transformer_batch = batch_size * 2 if do_classifier_free_guidance else batch_size
+        key = (compile_backend, height, width, transformer_batch, do_classifier_free_guidance, max_sequence_length,
+               proportional_attn)
+        if key not in self.compiled_shapes:
+            # Those graphs all share one cache and can't be dropped one at a time, so once too many shapes have been
+            # compiled, drop all of the transformer's graphs and start over. Cycling through more shapes than
+            # compiled_shapes_size therefore recompiles on every switch.
+            if len(self.compiled_shapes) >= self.compiled_shapes_size:
+                logger.info("Too many compiled transformer shapes, dropping the transformer's compiled graphs")
+                reset_compiled_code(type(self.transformer).forward)
+                self.compiled_shapes.clear()
+            logger.info(f"Compiling transformer for shape: {key}")
+            self.compiled_shapes.add(key)
+
+        if compile_backend not in self.compiled_transformers:
+            if compile_backend == "inductor":
+                compiled = torch.compile(self.transformer, mode="reduce-overhead", fullgraph=True, dynamic=False)
+            else:
+                # Plain CUDA Graph capture without Inductor's kernel rewrites, so outputs match eager
+                compiled = torch.compile(self.transformer, backend=compile_backend, fullgraph=True, dynamic=False)
+            self.compiled_transformers[compile_backend] = compiled
+        return self.compiled_transformers[compile_backend]
+
+    def encode_prompt_cached(self, prompt, max_sequence_length, clean_caption, preprocess=True):
+        # Workflows mostly rerun the same (negative) prompt, so skip the text encoder when we've seen it before
+        key = (prompt, max_sequence_length, clean_caption, preprocess)
+        if key in self.prompt_cache:
+            self.prompt_cache.move_to_end(key)
+            return self.prompt_cache[key]
+
+        device = self._execution_device
+        # Always pad to max_sequence_length so prompt and negative prompt line up and shapes stay static.
+        # Gemma's tokenizer pads on the left, which would shift the prompt's positions with its length;
+        # pad on the right so the real tokens keep the positions and causal context of the unpadded prompt.
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "right"
+        try:
+            text_inputs = self.tokenizer(
+                self._text_preprocessing(prompt, clean_caption=clean_caption) if preprocess else [prompt],
+                padding="max_length",
+                max_length=max_sequence_length,
+                truncation=True,
+                return_tensors="pt",
+            )
+        finally:
+            self.tokenizer.padding_side = padding_side
+        prompt_attention_mask = text_inputs.attention_mask.to(device)
+        prompt_embeds = self.text_encoder(
+            text_inputs.input_ids.to(device), attention_mask=prompt_attention_mask, output_hidden_states=True
+        ).hidden_states[-2]
+        # Clone so the cache owns its tensor, a compiled text encoder overwrites its CUDA Graph output on the next encode
+        prompt_embeds = prompt_embeds.to(dtype=self.text_encoder.dtype).clone()
+
+        self.prompt_cache[key] = (prompt_embeds, prompt_attention_mask)
+        if len(self.prompt_cache) > self.prompt_cache_size:
+            self.prompt_cache.popitem(last=False)
+        return prompt_embeds, prompt_attention_mask
+
+    @torch.no_grad()
+    def __call__(self, prompt, negative_prompt, ode, height, width, guidance_scale=4.0, num_images_per_prompt=1,
+                 generator=None, latents=None, clean_caption=True, max_sequence_length=256, scaling_watershed=1.0,
+                 proportional_attn=True, compile_backend=None, output_type="pt", denormalize=True):
+        device = self._execution_device
+        do_classifier_free_guidance = guidance_scale > 1.0
+        transformer = self.get_transformer(compile_backend, height, width, num_images_per_prompt,
+                                           do_classifier_free_guidance, max_sequence_length, proportional_attn)
+
+        # Calculate the default image size based on the transformer's configuration
+        default_image_size = self.transformer.config.sample_size * self.vae_scale_factor
+        cross_attention_kwargs = {}
+        if proportional_attn:
+            cross_attention_kwargs["base_sequence_length"] = (default_image_size // 16) ** 2
+
+        prompt_embeds, prompt_attention_mask = self.encode_prompt_cached(prompt, max_sequence_length, clean_caption)
+        prompt_embeds = prompt_embeds.expand(num_images_per_prompt, -1, -1)
+        prompt_attention_mask = prompt_attention_mask.expand(num_images_per_prompt, -1)
+        if do_classifier_free_guidance:
+            # Like diffusers, the negative prompt is encoded without caption preprocessing
+            negative_prompt_embeds, negative_prompt_attention_mask = self.encode_prompt_cached(
+                negative_prompt or "", max_sequence_length, clean_caption, preprocess=False)
+            # Run the conditional and unconditional branches as a single batched forward pass
+            prompt_embeds = torch.cat([prompt_embeds, negative_prompt_embeds.expand(num_images_per_prompt, -1, -1)], dim=0)
+            prompt_attention_mask = torch.cat(
+                [prompt_attention_mask, negative_prompt_attention_mask.expand(num_images_per_prompt, -1)], dim=0)
+
+        latents = self.prepare_latents(
+            num_images_per_prompt,
+            self.transformer.config.in_channels,
+            height,
+            width,
+            prompt_embeds.dtype,
+            device,
+            generator,
+            latents,
+        )
+
+        # Precompute the 2D rotary embeddings for both sides of the scaling watershed.
+        # They only depend on the resolution, so there is no need to rebuild them every step.
+        # The transformer only reads one position per latent patch, so size the tables to the patch grid.
+        scale_factor = math.sqrt(width * height / default_image_size**2)
+        head_dim = self.transformer.config.hidden_size // self.transformer.config.num_attention_heads
+        patch_pixels = self.vae_scale_factor * self.transformer.config.patch_size
+        rope_pre = get_2d_rotary_pos_embed_lumina(
+            head_dim, height // patch_pixels, width // patch_pixels, linear_factor=scale_factor, ntk_factor=1.0, device=device)
+        rope_post = get_2d_rotary_pos_embed_lumina(
+            head_dim, height // patch_pixels, width // patch_pixels, linear_factor=1.0, ntk_factor=scale_factor, device=device)
+
+        # Count model evaluations in Python rather than reading t back from the GPU.
+        # ode.t is still on the CPU, so finding the watershed step does not sync either.
+        watershed_step = int((ode.t[:-1] < scaling_watershed).sum())
+        eval_idx = 0
+
+        def model_fn(x, t):
+            nonlocal eval_idx
+            # Apply time-aware scaling
+            step_idx = eval_idx // ode.evals_per_step
+            image_rotary_emb = rope_pre if step_idx < watershed_step else rope_post
+            eval_idx += 1
+
+            if do_classifier_free_guidance:
+                x = torch.cat([x, x], dim=0)
+                t = torch.cat([t, t], dim=0)
+
+            noise_pred = transformer(
+                x, t, prompt_embeds, prompt_attention_mask, image_rotary_emb,
+                cross_attention_kwargs=cross_attention_kwargs, return_dict=False,
+            )[0].chunk(2, dim=1)[0]
+
+            # Copy out of the CUDA Graph's output buffer, the solver keeps earlier evaluations around (e.g. rk4)
+            if do_classifier_free_guidance:
+                noise_pred_cond, noise_pred_uncond = noise_pred.chunk(2, dim=0)
+                noise_pred = noise_pred_cond.clone()
+                # Like the reference implementation, guidance is only applied to the first three channels
+                noise_pred[:, :3].sub_(noise_pred_uncond[:, :3]).mul_(guidance_scale).add_(noise_pred_uncond[:, :3])
+            else:
+                noise_pred = noise_pred.clone()
+
+            return noise_pred
+
+        latents = ode.sample(model_fn, x=latents)
+
+        if output_type == "latent":
+            image = latents
+        else:
+            latents = latents / self.vae.config.scaling_factor
+            image = self.vae.decode(latents, return_dict=False)[0]
+            # With denormalize=False the caller gets the VAE output as-is, in [-1, 1]
+            if denormalize or output_type != "pt":
+                image = self.image_processor.postprocess(image, output_type=output_type)
+
+        self.maybe_free_model_hooks()
+
+        return ImagePipelineOutput(images=image)
+
 class LuminaDiffusersNode:
     @classmethod
     def INPUT_TYPES(cls):
@@ -16,7 +278,7 @@ class LuminaDiffusersNode:
                 "model_path": ("STRING", {"default": "Lumina-Next-SFT-diffusers"}),
                 "prompt": ("STRING", {"multiline": True}),
                 "negative_prompt": ("STRING", {"multiline": True}),
-                "num_inference_steps": ("INT", {"default": 30, "min": 1, "max": 200}),
+                "num_inference_steps": ("INT", {"default": 30, "min": 2, "max": 200}),
                 "guidance_scale": ("FLOAT", {"default": 4.0, "min": 0.1, "max": 20.0}),
                 "width": ("INT", {"default": 1024, "min": 512, "max": 2048, "step": 64}),
                 "height": ("INT", {"default": 1024, "min": 512, "max": 2048, "step": 64}),
@@ -28,6 +290,9 @@ class LuminaDiffusersNode:
                 "max_sequence_length": ("INT", {"default": 256, "min": 64, "max": 512}),
                 "t_shift": ("INT", {"default": 4, "min": 1, "max": 20}),
                 "solver": (["euler", "midpoint", "rk4"], {"default": 'midpoint'}),
+                "compile_model": ("BOOLEAN", {"default": True}),
+                "compile_backend": (["inductor", "cudagraphs"], {"default": 'cudagraphs'}),
+                "quantization": (["none", "fp8", "int8"], {"default": 'none'}),
             }
         }
 
@@ -35,164 +300,155 @@ class LuminaDiffusersNode:
     FUNCTION = "generate"
     CATEGORY = "LuminaWrapper"
 
-    def __init__(self):
-        self.pipe = None
-
-    def load_model(self, model_path):
+    def load_model(self, model_path, compile_model=True, quantization="none"):
+        # Returns the shared pipeline, or None if loading failed. Nodes don't keep a reference of their own,
+        # so clear_pipeline_cache can actually free the model.
+        cache_key = (model_path, quantization)
+        if cache_key not in _PIPE_CACHE:
+            # Only evict when another pipeline is actually loaded, there is nothing to free on the first load
+            if _PIPE_CACHE:
+                clear_pipeline_cache()
+            pipe = self.build_pipeline(model_path, quantization)
+            if pipe is None:
+                return None
+            _PIPE_CACHE[cache_key] = pipe
+
+        pipe = _PIPE_CACHE[cache_key]
+        pipe.set_components_compiled(compile_model)
+        return pipe
+
+    def build_pipeline(self, model_path, quantization):
         try:
             device = mm.get_torch_device()
             dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
 
-            print(f"Loading Lumina model from: {model_path}")
-            print(f"Device: {device}, Dtype: {dtype}")
+            logger.info(f"Loading Lumina model from: {model_path}")
+            logger.info(f"Device: {device}, Dtype: {dtype}")
 
             full_path = os.path.join(os.path.dirname(__file__), model_path)
             if not os.path.exists(full_path):
-                print(f"Model not found. Downloading Lumina model to: {full_path}")
-                self.pipe = LuminaText2ImgPipeline.from_pretrained("Alpha-VLLM/Lumina-Next-SFT-diffusers", torch_dtype=dtype)
-                self.pipe.save_pretrained(full_path)
+                logger.info(f"Model not found. Downloading Lumina model to: {full_path}")
+                base_pipe = LuminaText2ImgPipeline.from_pretrained("Alpha-VLLM/Lumina-Next-SFT-diffusers", torch_dtype=dtype)
+                base_pipe.save_pretrained(full_path)
             else:
-                self.pipe = LuminaText2ImgPipeline.from_pretrained(full_path, torch_dtype=dtype)
-
-            self.pipe.scheduler = FlowMatchEulerDiscreteScheduler.from_config(self.pipe.scheduler.config)
-            self.pipe.to(device)
-            print("Pipeline successfully loaded and moved to device.")
+                base_pipe = LuminaText2ImgPipeline.from_pretrained(full_path, torch_dtype=dtype)
+
+            # Build our pipeline from the loaded components so the saved model stays a stock LuminaText2ImgPipeline
+            base_pipe.scheduler = FlowMatchEulerDiscreteScheduler.from_config(base_pipe.scheduler.config)
+            pipe = LuminaCustomPipeline(**base_pipe.components)
+
+            # Allow TF32/reduced-precision accumulation for the transformer's matmuls and the VAE's convolutions
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.backends.cuda.matmul.allow_bf16_reduced_precision_reduction = True
+            torch.set_float32_matmul_precision("high")
+            # Don't let Dynamo fall back to eager before get_transformer resets the caches for too many shapes
+            torch._dynamo.config.cache_size_limit = 128
+            enable_compile_cache()
+
+            pipe.to(device)
+            quantize_transformer(pipe.transformer, quantization)
+            pipe.vae.to(memory_format=torch.channels_last)
+            pipe.vae.decode = channels_last_decode(pipe.vae.decode)
+            logger.info("Pipeline successfully loaded and moved to device.")
+            return pipe
         except Exception as e:
-            print(f"Error in load_model: {str(e)}")
-            traceback.print_exc()
+            logger.exception(f"Error in load_model: {str(e)}")
+            return None
 
     def generate(self, model_path, prompt, negative_prompt, num_inference_steps, guidance_scale, width, height, seed,
-                 batch_size, scaling_watershed, proportional_attn, clean_caption, max_sequence_length, t_shift, solver):
+                 batch_size, scaling_watershed, proportional_attn, clean_caption, max_sequence_length, t_shift, solver, compile_model, compile_backend, quantization):
         try:
-            if self.pipe is None:
-                print("Pipeline not loaded. Attempting to load model.")
-                self.load_model(model_path)
+            device = mm.get_torch_device()
+            logger.debug(f"Generation device: {device}")
+            # reduce-overhead and the cudagraphs backend both rely on CUDA Graphs, so only compile on CUDA
+            compile_model = compile_model and device.type == "cuda"
 
-            if self.pipe is None:
-                raise ValueError("Failed to load the pipeline.")
+            pipe = self.load_model(model_path, compile_model, quantization)
 
-            device = mm.get_torch_device()
-            print(f"Generation device: {device}")
+            if pipe is None:
+                raise ValueError("Failed to load the pipeline.")
 
             if seed == -1:
+                # Draw from OS entropy, torch's global RNG is seeded by other nodes and would repeat the same "random" seed
                 seed = int.from_bytes(os.urandom(4), "big")
             generator = torch.Generator(device=device).manual_seed(seed)
 
-            # Calculate the default image size based on the transformer's configuration
-            default_image_size = self.pipe.transformer.config.sample_size * self.pipe.vae_scale_factor
-
-            # Set cross_attention_kwargs as an attribute if proportional_attn is True
-            if proportional_attn:
-                self.pipe.cross_attention_kwargs = {"base_sequence_length": (default_image_size // 16) ** 2}
-            else:
-                self.pipe.cross_attention_kwargs = None
+            # Info rather than debug, a random seed can't be recovered any other way
+            logger.info(f"Starting generation with seed: {seed}")
 
-            # Configure time-aware scaling
-            time_shift_factor = 1 + t_shift
-            self.pipe.scheduler.config.shift = time_shift_factor
+            # Create ODE solver. It applies the time shift to its own schedule, the pipeline's scheduler is never stepped.
+            # Shift by 1 + t_shift, the value the scheduler used to get, so existing workflows keep their schedule.
+            ode = ODE(num_inference_steps, solver, 1 + t_shift)
 
-            print(f"Starting generation with seed: {seed}")
+            # Draw the initial noise up front so the RNG stays out of the compiled sampling loop
+            latent_shape = (batch_size, 4, height // 8, width // 8)
+            latents = torch.randn(latent_shape, generator=generator, dtype=pipe.transformer.dtype, device=device)
 
             # Prepare the arguments for the pipeline call
             pipe_args = {
                 "prompt": prompt,
                 "negative_prompt": negative_prompt,
+                "ode": ode,
                 "height": height,
                 "width": width,
-                "num_inference_steps": num_inference_steps,
                 "guidance_scale": guidance_scale,
                 "num_images_per_prompt": batch_size,
-                "generator": generator,
+                "latents": latents,
                 "output_type": "pt",
+                "denormalize": False,
                 "clean_caption": clean_caption,
                 "max_sequence_length": max_sequence_length,
                 "scaling_watershed": scaling_watershed,
+                "proportional_attn": proportional_attn,
+                "compile_backend": compile_backend if compile_model else None,
             }
 
-            # Create ODE solver
-            ode = ODE(num_inference_steps, solver, t_shift)
-
-            # Modify the pipeline's __call__ method to use our custom ODE solver
-            original_call = self.pipe.__call__
-
-            def custom_call(**kwargs):
-                @torch.no_grad()
-                def model_fn(x, t, **model_kwargs):
-                    # Apply time-aware scaling
-                    scale_factor = math.sqrt(width * height / default_image_size**2)
-                    current_t = t.item()
-                    linear_factor = scale_factor if current_t < scaling_watershed else 1.0
-                    ntk_factor = 1.0 if current_t < scaling_watershed else scale_factor
-
-                    # Generate 2D rotary embeddings
-                    image_rotary_emb = get_2d_rotary_pos_embed_lumina(
-                        self.pipe.transformer.config.hidden_size // self.pipe.transformer.config.num_attention_heads,
-                        height // 8,
-                        width // 8,
-                        linear_factor=linear_factor,
-                        ntk_factor=ntk_factor
-                    )
-
-                    # Add image_rotary_emb to model_kwargs
-                    model_kwargs['image_rotary_emb'] = image_rotary_emb
-
-                    return self.pipe.transformer(x, t, **model_kwargs)
-
-                return ode.sample(model_fn, **kwargs)
-
-            self.pipe.__call__ = custom_call
-
             # Generate images
-            output = self.pipe(**pipe_args)
-
-            # Restore original __call__ method
-            self.pipe.__call__ = original_call
+            output = pipe(**pipe_args)
 
-            processed_images = self.process_output(output.images)
+            # Copy and map the VAE output to [0, 1] once for LATENT, then build IMAGE from that tensor
             latents_dict = self.process_latents(output.images, height, width)
+            processed_images = self.process_output(latents_dict["samples"])
 
             return (processed_images, latents_dict)
 
         except Exception as e:
-            print(f"Error in generate: {str(e)}")
-            traceback.print_exc()
+            logger.exception(f"Error in generate: {str(e)}")
             return (torch.zeros((batch_size, height, width, 3), dtype=torch.float32),
                     {"samples": torch.zeros((batch_size, 4, height // 8, width // 8), dtype=torch.float32)})
 
     def process_output(self, images):
-        print(f"Raw output images shape: {images.shape}")
-        print(f"Raw output images dtype: {images.dtype}")
-        print(f"Raw output images min: {images.min()}, max: {images.max()}")
-
-        # Convert to float32 for processing
-        images = images.float()
-
-        # Adjust scaling based on the actual output range
-        if images.min() >= 0 and images.max() <= 1:
-            # Images are already in [0, 1] range
-            images = images.clamp(0, 1)
-        else:
-            # Assume images are in [-1, 1] range
-            images = (images + 1) / 2
-            images = images.clamp(0, 1)
+        # min()/max() block on the GPU, so only evaluate them when debug logging is on
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(f"Denormalized images shape: {images.shape}")
+            logger.debug(f"Denormalized images dtype: {images.dtype}")
+            logger.debug(f"Denormalized images min: {images.min()}, max: {images.max()}")
 
-        # Ensure the shape is correct (batch, height, width, channels)
-        images = images.permute(0, 2, 3, 1)
+        # images is the float32 [0, 1] LATENT tensor, so this only has to permute to (batch, height, width, channels)
+        images = images.permute(0, 2, 3, 1).contiguous()
 
-        print(f"Processed images shape: {images.shape}")
-        print(f"Processed images dtype: {images.dtype}")
-        print(f"Processed images min: {images.min()}, max: {images.max()}")
+        if debug:
+            logger.debug(f"Processed images shape: {images.shape}")
+            logger.debug(f"Processed images dtype: {images.dtype}")
+            logger.debug(f"Processed images min: {images.min()}, max: {images.max()}")
 
         return images
 
     def process_latents(self, images, height, width):
-        # Prepare latents for output
-        latents = images.clone().detach()  # Clone and detach to avoid modifying the original
-        latents = latents.to(dtype=torch.float32)  # Ensure float32 dtype
-        
-        print(f"Latents shape before processing: {latents.shape}")
-        print(f"Latents dtype: {latents.dtype}")
-        print(f"Latents min: {latents.min()}, max: {latents.max()}")
+        # Prepare latents for output. Always copy: with a compiled VAE, images lives in a CUDA Graph buffer
+        # that the next generate overwrites, and .to() alone is a no-op when it is already float32.
+        # The pipeline skips denormalization, so map the decoded [-1, 1] range back to [0, 1] here, in place on the copy.
+        # This is the only mapping pass, process_output builds IMAGE from the result.
+        # The VAE decodes in channels_last, hand downstream nodes a plain contiguous NCHW tensor.
+        latents = images.detach().to(dtype=torch.float32, memory_format=torch.contiguous_format, copy=True)
+        latents.add_(1).mul_(0.5).clamp_(0, 1)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Latents shape before processing: {latents.shape}")
+            logger.debug(f"Latents dtype: {latents.dtype}")
+            logger.debug(f"Latents min: {latents.min()}, max: {latents.max()}")
 
         # Create a dictionary with 'samples' key for compatibility
         return {"samples": latents}
@@ -1,27 +1,24 @@
+import functools
 import torch
 from torchdiffeq import odeint
 from comfy.utils import ProgressBar
 from tqdm import tqdm
 
-def get_2d_rotary_pos_embed_lumina(head_dim, height, width, linear_factor=1.0, ntk_factor=1.0):
-    x = torch.arange(width).float() * linear_factor
-    y = torch.arange(height).float() * linear_factor
-    x, y = torch.meshgrid(x, y, indexing="ij")
-    pos = torch.stack([x, y], dim=-1)
-    pos = pos.view(-1, 2)
-
-    # Adjust the dimension to match head_dim
+# Two tables (both sides of the scaling watershed) for each of the last couple of resolutions
+@functools.lru_cache(maxsize=4)
+def get_2d_rotary_pos_embed_lumina(head_dim, height, width, linear_factor=1.0, ntk_factor=1.0, theta=10000.0, device=None):
+    # Half of head_dim encodes the row position and half the column position.
+    # Returns complex frequencies of shape (height, width, head_dim // 2), the layout the Lumina transformer expects.
+    # Built directly on `device`. Results are cached and shared between callers, so treat them as read-only.
     dim = head_dim // 2
-    inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2).float() / dim))
-    sinusoid_inp = torch.einsum("i,j->ij", pos.view(-1), inv_freq)
-    sinusoid_inp = sinusoid_inp * ntk_factor
+    inv_freq = 1.0 / ((theta * ntk_factor) ** (torch.arange(0, dim, 2, dtype=torch.float32, device=device) / dim)) / linear_factor
 
-    sin = torch.sin(sinusoid_inp)
-    cos = torch.cos(sinusoid_inp)
-    sin_pos = torch.cat([sin, sin], dim=-1).view(height, width, head_dim)
-    cos_pos = torch.cat([cos, cos], dim=-1).view(height, width, head_dim)
+    freqs_h = torch.outer(torch.arange(height, dtype=torch.float32, device=device), inv_freq)
+    freqs_w = torch.outer(torch.arange(width, dtype=torch.float32, device=device), inv_freq)
+    emb_h = torch.polar(torch.ones_like(freqs_h), freqs_h).view(height, 1, dim // 2, 1).expand(height, width, dim // 2, 1)
+    emb_w = torch.polar(torch.ones_like(freqs_w), freqs_w).view(1, width, dim // 2, 1).expand(height, width, dim // 2, 1)
 
-    return sin_pos, cos_pos
+    return torch.cat([emb_h, emb_w], dim=-1).flatten(2)
 
 class ODE:
     def __init__(self, num_steps, sampler_type="midpoint", time_shifting_factor=None, strength=1.0, t0=0.0, t1=1.0):
@@ -31,8 +28,13 @@ class ODE:
 
         if strength != 1.0:
             self.t = self.t[int(num_steps * (1 - strength)):]
+        if len(self.t) < 2:
+            # The time grid needs a start and an end point for the solver to take any step
+            raise ValueError(f"ODE sampling needs at least 2 time points, got {len(self.t)}")
 
         self.sampler_type = sampler_type
+        # Model evaluations per step for torchdiffeq's fixed-grid solvers
+        self.evals_per_step = {"euler": 1, "midpoint": 2, "rk4": 4}[sampler_type]
         if self.sampler_type == "euler":
             total_steps = len(self.t)
         else:
@@ -41,17 +43,19 @@ class ODE:
         self.pbar = tqdm(total=total_steps, desc='ODE Sampling')
 
     def sample(self, model_fn, **model_kwargs):
-        device = next(model_fn.parameters()).device
+        x = model_kwargs.pop('x')
+        device = x.device
 
         def _fn(t, x):
-            t = torch.ones(x.size(0)).to(device) * t
+            # Broadcast the scalar time over the whole batch without allocating or copying from the CPU
+            t = t.expand(x.size(0))
             model_output = model_fn(x, t, **model_kwargs)
             self.pbar.update(1)
             self.comfy_pbar.update(1)
             return model_output
 
         t = self.t.to(device)
-        x = model_kwargs.pop('x')
-        samples = odeint(_fn, x, t, method=self.sampler_type)
+        # Step over the full time grid but only keep the endpoints instead of every intermediate state
+        samples = odeint(_fn, x, t[[0, -1]], method=self.sampler_type, options={"grid_constructor": lambda func, y0, _: t})
         self.pbar.close()
-        return samples
+        return samples[-1]